@@ -1,12 +1,31 @@
 #!/usr/bin/env python3
+import io
 import os
+import sys
 import argparse
+from contextlib import redirect_stdout
 import nibabel as nib
 import numpy as np
-import csv
-from scipy.ndimage import label, center_of_mass
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from scipy.ndimage import label, center_of_mass, find_objects, maximum
 import pandas as pd
 
+try:
+    import cc3d
+except ImportError:
+    # cc3d is optional: scipy.ndimage.label is used for the instance segmentation otherwise
+    cc3d = None
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional: fall back to plain Python if it is not installed
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Organ label mapping with anatomical metadata:
 # Format: label_id: 
@@ -74,6 +93,17 @@ ALL_MR_LABELS_INFO = {
 # Simple id->name mapping
 ALL_MR_LABELS = {k: v[0] for k, v in ALL_MR_LABELS_INFO.items()}
 
+# Columns of the per-subject lesion stats CSV
+LESION_STATS_COLUMNS = [
+    "lesion_id", "volume_ml", "SUV_max", "SUV_95percentile",
+    "SUV95_aorta", "SUV95_liver",
+    "organ1_name", "organ1_pct",
+    "organ2_name", "organ2_pct",
+    "above_diaphragm", "laterality",
+    "lymph_node_region",
+    "deauville_score"
+]
+
 
 def print_summary_from_csv(csv_path, topn=5):
     """
@@ -166,7 +196,7 @@ def print_summary_from_csv(csv_path, topn=5):
 
 def get_pet_path(mask_path):
     base_dir = os.path.dirname(mask_path)
-    fname_noext = os.path.splitext(os.path.splitext(os.path.basename(mask_path))[0])[0]
+    fname_noext = os.path.basename(mask_path).removesuffix(".nii.gz")
     if "_LYM" in fname_noext:
         subj_prefix = fname_noext.split("_LYM")[0]
         return os.path.join(base_dir, f"{subj_prefix}_LYM.nii.gz")
@@ -175,6 +205,19 @@ def get_pet_path(mask_path):
 
 
 
+@lru_cache(maxsize=1)
+def load_pet(pet_path):
+    """
+    Loads a PET volume as float32 (plenty for SUV statistics, half the bytes of float64).
+    The last volume is cached per process, so label maps sharing one PET image
+    (e.g. several segmentations of the same scan) only decompress it once.
+    The returned array is read-only since it is shared between calls.
+    """
+    pet_data = np.asarray(nib.load(pet_path).dataobj, dtype=np.float32)
+    pet_data.flags.writeable = False
+    return pet_data
+
+
 def classify_lesion_position(organ_names, lesion_mask=None, organ_data=None, site=None):
     """
     Classifies lesion position as above/below diaphragm and left/right
@@ -207,8 +250,8 @@ def classify_lesion_position(organ_names, lesion_mask=None, organ_data=None, sit
             lesion_c = lesion_centroid(lesion_mask)
             left_c = lesion_centroid(arm_left_mask)
             right_c = lesion_centroid(arm_right_mask)
-            dist_left = np.linalg.norm(lesion_c - left_c)
-            dist_right = np.linalg.norm(lesion_c - right_c)
+            dist_left = squared_distance(lesion_c, left_c)
+            dist_right = squared_distance(lesion_c, right_c)
             side = "left" if dist_left < dist_right else "right"
 
     return above_flag, side
@@ -221,14 +264,48 @@ def lesion_centroid(mask):
     return np.array(center_of_mass(mask))
 
 
-def classify_lesion(organ_ids, lesion_mask, organ_data):
+def percentile_95(values):
+    # Same linear interpolation as np.percentile(values, 95), but selects the two
+    # neighbouring ranks with np.partition (O(n)) instead of sorting everything.
+    # Partitions in place: callers pass the temporary array from boolean indexing.
+    values = np.ravel(values)
+    pos = 0.95 * (values.size - 1)
+    k = int(pos)
+    if k + 1 >= values.size:
+        values.partition(k)
+        return float(values[k])
+    values.partition((k, k + 1))
+    lo, hi = float(values[k]), float(values[k + 1])
+    return lo + (pos - k) * (hi - lo)
+
+
+def squared_distance(a, b):
+    # Ranking by squared distance gives the same order as the Euclidean norm, without the sqrt
+    d = a - b
+    return float(d.dot(d))
+
+
+@njit(cache=True)
+def closest_centroid(point, centroids):
+    # Index of the row in `centroids` (N x 3) closest to `point`; ties keep the first row
+    best_idx = 0
+    best_dist = np.inf
+    for i in range(centroids.shape[0]):
+        dist = 0.0
+        for j in range(point.shape[0]):
+            diff = point[j] - centroids[i, j]
+            dist += diff * diff
+        if dist < best_dist:
+            best_dist = dist
+            best_idx = i
+    return best_idx
+
+
+def classify_lesion(organ_ids, lesion_c, organ_data):
     # Handle empty list
     if not organ_ids:
         return "unknown"
 
-    # Compute lesion centroid
-    lesion_c = lesion_centroid(lesion_mask)
-
     # Get lymph node sites for each overlapping organ
     possible_sites = []
     for oid in organ_ids:
@@ -258,10 +335,10 @@ def classify_lesion(organ_ids, lesion_mask, organ_data):
 
                 if clav_centroids:
                     # Find closest clavicle
-                    closest_cid = min(
-                        clav_centroids,
-                        key=lambda cid: np.linalg.norm(lesion_c - clav_centroids[cid])
-                    )
+                    clav_ids = list(clav_centroids)
+                    closest_cid = clav_ids[closest_centroid(
+                        lesion_c, np.array([clav_centroids[cid] for cid in clav_ids])
+                    )]
                     closest_clav_c = clav_centroids[closest_cid]
 
                     if lesion_c[z_idx] > closest_clav_c[z_idx]:
@@ -276,10 +353,10 @@ def classify_lesion(organ_ids, lesion_mask, organ_data):
                             arm_centroids[arm_side] = lesion_centroid(organ_data == aid)
 
                     if arm_centroids:
-                        closest_arm = min(
-                            arm_centroids,
-                            key=lambda k: np.linalg.norm(lesion_c - arm_centroids[k])
-                        )
+                        arm_sides = list(arm_centroids)
+                        closest_arm = arm_sides[closest_centroid(
+                            lesion_c, np.array([arm_centroids[k] for k in arm_sides])
+                        )]
                         return f"{closest_arm}-{site}"
 
                     return site  # fallback no arms → no laterality
@@ -293,39 +370,41 @@ def analyze_lesions(label_map_path, lesion_pattern="LYM_label.nii.gz",
     # Find anatomy segmentation
     print("Searching for anatomy/organ segmentation...")
     anat_path = None
-    for f in os.listdir(os.path.dirname(label_map_path)):
-        if anat_pattern in f:
-            anat_path = os.path.join(os.path.dirname(label_map_path), f)
-            break
+    with os.scandir(os.path.dirname(label_map_path)) as entries:
+        for e in entries:
+            if anat_pattern in e.name:
+                anat_path = e.path
+                break
     
     # Find PET image
     pet_path = get_pet_path(label_map_path)
 
     # Load and check shapes
+    # Headers are parsed once here; the image objects are reused below to read the data
     label_img = nib.load(label_map_path)
+    anat_img = nib.load(anat_path)
     label_shape = label_img.shape
-    anat_shape = nib.load(anat_path).shape
-    pet_shape = nib.load(pet_path).shape
-    data = label_img.get_fdata().astype(np.uint8)
+    anat_shape = anat_img.shape
+    # Read the stored integer labels directly instead of going through a float64 copy
+    data = np.asanyarray(label_img.dataobj).astype(np.uint8, copy=False)
 
     # If no lesion found, skip analysis and create empty CSV
     if np.sum(data) == 0:
         print("No lesion found in label map. Skipping analysis for this subject.")
-        base = os.path.splitext(os.path.splitext(label_map_path)[0])[0]
+        base = label_map_path.removesuffix(".nii.gz")
         csv_path = base + "_lesion_stats.csv"
-        fieldnames = [ 
-            "lesion_id", "volume_ml", "SUV_max", "SUV_95percentile",
-            "SUV95_aorta", "SUV95_liver",
-            "organ1_name", "organ1_pct",
-            "organ2_name", "organ2_pct",
-            "above_diaphragm", "laterality",
-            "lymph_node_region",
-            "deauville_score"
-        ]
-        with open(csv_path, "w", newline="") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            return []
+        pd.DataFrame(columns=LESION_STATS_COLUMNS).to_csv(csv_path, index=False)
+        return []
+
+    # Load PET image (the PET shape is taken from the cached array, so its header is only parsed in load_pet)
+    if os.path.exists(pet_path):
+        print(f"Loading PET image: {pet_path}")
+        pet_data = load_pet(pet_path)
+        pet_shape = pet_data.shape
+    else:
+        print(f"WARNING: PET image not found for {label_map_path}. SUV metrics will be skipped.")
+        pet_data = None
+        pet_shape = label_shape
 
     if label_shape != anat_shape or label_shape != pet_shape:
         raise ValueError(
@@ -340,32 +419,30 @@ def analyze_lesions(label_map_path, lesion_pattern="LYM_label.nii.gz",
     img = label_img
 
     print("Performing instance segmentation...")
-    struct = np.ones((3, 3, 3), dtype=np.uint8)
-    labeled_array, num_features = label(data, structure=struct)
+    if cc3d is not None:
+        # cc3d numbers components in memory order: a C-ordered input keeps the same
+        # lesion IDs as scipy's label (nibabel hands back Fortran-ordered arrays)
+        labeled_array, num_features = cc3d.connected_components(
+            np.ascontiguousarray(data), connectivity=26, binary_image=True, return_N=True
+        )
+    else:
+        struct = np.ones((3, 3, 3), dtype=np.uint8)
+        labeled_array, num_features = label(data, structure=struct)
     print(f"Found {num_features} lesion instances.")
 
-    base = os.path.splitext(os.path.splitext(label_map_path)[0])[0]
+    base = label_map_path.removesuffix(".nii.gz")
     inst_path = base + "_inst.nii.gz"
     print(f"Saving instance segmentation to: {inst_path}")
     nib.save(nib.Nifti1Image(labeled_array, img.affine, img.header), inst_path)
 
-    # Load PET image
-    if os.path.exists(pet_path):
-        print(f"Loading PET image: {pet_path}")
-        pet_img = nib.load(pet_path)
-        pet_data = pet_img.get_fdata()
-    else:
-        print(f"WARNING: PET image not found for {label_map_path}. SUV metrics will be skipped.")
-        pet_data = None
-
     anat_data = None
     liver_suv95 = None
     aorta_suv95 = None
 
     if anat_path and os.path.exists(anat_path):
         print(f"Loading anatomy/organ segmentation: {anat_path}")
-        anat_img = nib.load(anat_path)
-        anat_data = anat_img.get_fdata().astype(int)
+        # Stored integer labels as int32, without a float64 + int64 copy of the whole volume
+        anat_data = np.asanyarray(anat_img.dataobj).astype(np.int32, copy=False)
 
         if pet_data is not None:
             # Liver and Aorta masks
@@ -373,38 +450,47 @@ def analyze_lesions(label_map_path, lesion_pattern="LYM_label.nii.gz",
             aorta_mask = anat_data == 23  # aorta label ID
 
             if np.any(liver_mask):
-                liver_suv95 = float(np.percentile(pet_data[liver_mask], 95))
+                liver_suv95 = percentile_95(pet_data[liver_mask])
             if np.any(aorta_mask):
-                aorta_suv95 = float(np.percentile(pet_data[aorta_mask], 95))
+                aorta_suv95 = percentile_95(pet_data[aorta_mask])
 
     else:
         print(f"WARNING: Anatomy segmentation not found for {label_map_path}")
 
-    voxel_volume_ml = np.prod(img.header.get_zooms()) / 1000.0
+    # Plain Python float so the per-lesion volume is not a numpy scalar operation; the division
+    # stays in float32 (as the zooms are) so the CSV volumes are the same as before
+    voxel_volume_ml = float(np.prod(img.header.get_zooms()) / 1000.0)
     lesions_info = []
 
     print("Analyzing individual lesions...")
+    # Per-lesion statistics in one pass over the volume each, instead of one
+    # full-volume mask per lesion; the rest only reads each lesion's bounding box
+    lesion_ids = np.arange(1, num_features + 1)
+    voxel_counts = np.bincount(labeled_array.ravel(), minlength=num_features + 1)[1:]
+    if pet_data is not None:
+        suv_maxima = maximum(pet_data, labeled_array, lesion_ids)
+    lesion_slices = find_objects(labeled_array)
+    suv_95ps = np.zeros(num_features)
+
     for lesion_id in range(1, num_features + 1):
-        lesion_mask = (labeled_array == lesion_id)
-        voxel_count = np.sum(lesion_mask)
+        sl = lesion_slices[lesion_id - 1]
+        lesion_mask = labeled_array[sl] == lesion_id
+        voxel_count = int(voxel_counts[lesion_id - 1])
         volume_ml = voxel_count * voxel_volume_ml
 
         # --- PET-based metrics for lesion ---
         if pet_data is not None:
-            suv_values = pet_data[lesion_mask]
-            if suv_values.size > 0:
-                suv_max = float(np.max(suv_values))
-                suv_95p = float(np.percentile(suv_values, 95))
-            else:
-                suv_max = suv_95p = 0.0
+            suv_max = float(suv_maxima[lesion_id - 1])
+            suv_95p = percentile_95(pet_data[sl][lesion_mask])
         else:
             suv_max = suv_95p = 0.0
+        suv_95ps[lesion_id - 1] = suv_95p
 
         # --- Organ overlap and main organ selection ---
         organ_info = [("None", 0.0), ("None", 0.0)]
         chosen_main_organ = None
         if anat_data is not None:
-            lesion_organs_raw, counts_raw = np.unique(anat_data[lesion_mask], return_counts=True)
+            lesion_organs_raw, counts_raw = np.unique(anat_data[sl][lesion_mask], return_counts=True)
             mask = lesion_organs_raw != 0
             lesion_organs = lesion_organs_raw[mask]
             counts = counts_raw[mask]
@@ -439,9 +525,11 @@ def analyze_lesions(label_map_path, lesion_pattern="LYM_label.nii.gz",
 
         # --- Lymph node region ---
         organ_ids = [oid for oid, name in ALL_MR_LABELS.items() if name in [o for o, _ in organ_info]]
+        # Centroid of the cropped mask, shifted back to full-volume coordinates
+        lesion_c = lesion_centroid(lesion_mask) + np.array([s.start for s in sl])
         ln_region = classify_lesion(
             organ_ids=organ_ids,
-            lesion_mask=lesion_mask,
+            lesion_c=lesion_c,
             organ_data=anat_data
         )
 
@@ -463,13 +551,10 @@ def analyze_lesions(label_map_path, lesion_pattern="LYM_label.nii.gz",
             "SUV95_liver": liver_suv95
         })
 
-    # Deauville score
-    for lesion in lesions_info:
-        lesion["deauville_score"] = None  # default to None
-
+    # Deauville score (each lesion's entry defaults to None above)
     highest_lesion = None
     if pet_data is not None and liver_suv95 is not None and aorta_suv95 is not None:
-        highest_lesion = max(lesions_info, key=lambda x: x["SUV_95percentile"])
+        highest_lesion = lesions_info[int(np.argmax(suv_95ps))]
         suv95_top = highest_lesion["SUV_95percentile"]
 
         if suv95_top <= aorta_suv95:
@@ -489,7 +574,8 @@ def analyze_lesions(label_map_path, lesion_pattern="LYM_label.nii.gz",
 def find_label_maps(input_path, pattern, onedir=False):
     print(f"Searching for label maps in: {input_path}")
     if onedir:
-        return [os.path.join(input_path, f) for f in os.listdir(input_path) if pattern in f]
+        with os.scandir(input_path) as entries:
+            return [e.path for e in entries if pattern in e.name and e.is_file()]
     matches = []
     for root, _, files in os.walk(input_path):
         for f in files:
@@ -499,6 +585,37 @@ def find_label_maps(input_path, pattern, onedir=False):
     return matches
 
 
+def process_subject(lm, onedir=False, anat_pattern="_all.nii.gz"):
+    """
+    Analyzes one lesion label map and writes its lesion stats CSV.
+    Runs inside a worker process, so it only returns what main() needs.
+    """
+    if onedir:
+        subject_id = os.path.basename(lm).split("_")[0]
+    else:
+        subject_id = os.path.basename(os.path.dirname(lm))
+
+    print(f"\n--- Processing subject: {subject_id} ---")
+
+    lesions_info = analyze_lesions(lm, anat_pattern=anat_pattern)
+    base = lm.removesuffix(".nii.gz")
+    csv_path = base + "_lesion_stats.csv"
+
+    # Write all lesions in one call, keeping only the CSV columns
+    df = pd.DataFrame(lesions_info, columns=LESION_STATS_COLUMNS)
+    # Nullable integers, so missing values stay empty and the rest are not written as floats
+    df = df.astype({"above_diaphragm": "Int64", "deauville_score": "Int64"})
+    df.to_csv(csv_path, index=False)
+
+    print(f"Finished processing subject: {subject_id}")
+    return subject_id, csv_path
+
+
+def init_worker():
+    """Line-buffered stdout in workers, so their log lines reach a redirected log whole and in order."""
+    sys.stdout.reconfigure(line_buffering=True)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Analyze lesion instances in label maps with PET and anatomy data, and classify upper-body lymph-node regions.")
     parser.add_argument("-i", "--input", required=True, help="Input directory or single directory to search.")
@@ -507,6 +624,7 @@ def main():
     parser.add_argument("--onedir", action="store_true", help="Only search the provided directory, not subfolders.")
     parser.add_argument("--topn", type=int, default=5, help="Number of largest lesions to print summary for.")
     parser.add_argument("--print_summary", action="store_true", help="Print summary report after processing.")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of subjects processed in parallel (default: half the CPU cores). Lower it if memory is tight, each worker holds a full label/PET/anatomy volume set.")
     args = parser.parse_args()
 
     label_maps = find_label_maps(args.input, args.lesion_pattern, args.onedir)
@@ -514,42 +632,26 @@ def main():
         print("No label maps found.")
         return
 
-    for lm in label_maps:
-        if args.onedir:
-            subject_id = os.path.basename(lm).split("_")[0]
-        else:
-            subject_id = os.path.basename(os.path.dirname(lm))
-
-        print(f"\n--- Processing subject: {subject_id} ---")
-
-        lesions_info = analyze_lesions(lm, ...)
-        base = os.path.splitext(os.path.splitext(lm)[0])[0]
-        csv_path = base + "_lesion_stats.csv"
-
-        with open(csv_path, "w", newline="") as csvfile:
-            fieldnames = [ 
-                "lesion_id", "volume_ml", "SUV_max", "SUV_95percentile",
-                "SUV95_aorta", "SUV95_liver",
-                "organ1_name", "organ1_pct",
-                "organ2_name", "organ2_pct",
-                "above_diaphragm", "laterality",
-                "lymph_node_region",
-                "deauville_score"
-            ]  
-
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-
-            for row in lesions_info:
-                # Only include keys that are in fieldnames
-                filtered = {k: row.get(k, "") for k in fieldnames}
-                writer.writerow(filtered)
-
-        print(f"Finished processing subject: {subject_id}")
-
-        # Only now, print the summary if flag set
-        if args.print_summary:
-            print_summary_from_csv(csv_path, args.topn)
+    jobs = args.jobs if args.jobs else max(1, (os.cpu_count() or 1) // 2)
+
+    # Subjects are independent: analyze them in parallel, each worker writing its own CSV
+    sys.stdout.reconfigure(line_buffering=True)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as executor:
+        futures = [executor.submit(process_subject, lm, args.onedir, args.anat_pattern) for lm in label_maps]
+
+        # Summaries are printed in input order (later subjects keep running meanwhile)
+        for future in futures:
+            subject_id, csv_path = future.result()
+
+            # Only now, print the summary if flag set
+            if args.print_summary:
+                # Written in one go, so worker log lines cannot land inside the summary block
+                summary = io.StringIO()
+                with redirect_stdout(summary):
+                    print(f"\n--- Summary for subject {subject_id} ---")
+                    print_summary_from_csv(csv_path, args.topn)
+                sys.stdout.write(summary.getvalue())
+                sys.stdout.flush()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
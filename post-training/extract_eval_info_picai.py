@@ -1,11 +1,51 @@
 import json
 import argparse
+import numpy as np
+
+try:
+    import ijson
+except ImportError:
+    # ijson is optional: without it the whole JSON file is loaded at once
+    ijson = None
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional: count_detections then runs as plain numpy
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+def iter_lesion_results(json_path):
+    """Yield (subject_id, lesions) pairs from the 'lesion_results' entry of a PICAI metrics JSON."""
+    with open(json_path, 'rb') as f:
+        if ijson is not None:
+            # Stream one subject at a time instead of materializing the full document
+            yield from ijson.kvitems(f, 'lesion_results', use_float=True)
+        else:
+            yield from json.load(f).get("lesion_results", {}).items()
+
+@njit(cache=True)
+def count_detections(arr, threshold):
+    """
+    Counts detections for one subject from a (n_lesions, >=2) float array of
+    [is_true_lesion, predicted_score, ...] rows.
+    Returns (true_positives, false_positives, false_negatives, total_predicted, ground_truth).
+    """
+    is_true_lesion = arr[:, 0] == 1
+    is_predicted = arr[:, 1] > threshold
+
+    true_positives = np.count_nonzero(is_true_lesion & is_predicted)
+    false_positives = np.count_nonzero(~is_true_lesion & is_predicted)
+    false_negatives = np.count_nonzero(is_true_lesion & ~is_predicted)
+    total_predicted = np.count_nonzero(is_predicted)
+    ground_truth = np.count_nonzero(is_true_lesion)
+    return true_positives, false_positives, false_negatives, total_predicted, ground_truth
 
-def evaluate_lesions(json_path, threshold=0.5):
-    with open(json_path, 'r') as f:
-        data = json.load(f)
 
-    lesion_results = data.get("lesion_results", {})
+def evaluate_lesions(json_path, threshold=0.5):
     report = {}
     metrics_accumulator = {
         "true_positives": 0,
@@ -15,31 +55,14 @@ def evaluate_lesions(json_path, threshold=0.5):
         "ground_truth_lesions": 0
     }
 
-    num_subjects = len(lesion_results)
-
-    for subject_id, lesions in lesion_results.items():
-        actual_detected = 0
-        false_positives = 0
-        false_negatives = 0
-        total_predicted = 0
-        ground_truth_total = 0
-
-        for lesion in lesions:
-            is_true_lesion = lesion[0] == 1
-            predicted_score = lesion[1]
-
-            if is_true_lesion:
-                ground_truth_total += 1
-
-            if predicted_score > threshold:
-                total_predicted += 1
-                if is_true_lesion:
-                    actual_detected += 1
-                else:
-                    false_positives += 1
-            else:
-                if is_true_lesion:
-                    false_negatives += 1
+    for subject_id, lesions in iter_lesion_results(json_path):
+        # One row per lesion: [is_true_lesion, predicted_score, ...]
+        arr = np.asarray(lesions, dtype=np.float64)
+        if arr.size == 0:
+            arr = np.zeros((0, 2))
+        actual_detected, false_positives, false_negatives, total_predicted, ground_truth_total = (
+            int(count) for count in count_detections(arr, threshold)
+        )
 
         # Compute subject-level true_lesion_detection_rate
         if ground_truth_total == 0:
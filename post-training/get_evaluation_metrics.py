@@ -1,6 +1,4 @@
 from picai_eval import Metrics
-import matplotlib.pyplot as plt
-from sklearn.metrics import PrecisionRecallDisplay, RocCurveDisplay
 
 # Provide the full path to the JSON file containing the PICAI metrics
 path2picai_metrics = "/home/marcantf/180n/results/test-lesion-segs/baselr-5e5/picai_eval.json"
@@ -36,6 +34,13 @@ print('Recall:', recall)
 
 ### Plotting section ###
 
+# Plotting libraries are slow to import, so only load them once the metrics are printed
+import matplotlib
+if not show_plots:
+    matplotlib.use("Agg")  # headless: skip the GUI backend probe
+import matplotlib.pyplot as plt
+from sklearn.metrics import PrecisionRecallDisplay, RocCurveDisplay
+
 # Pecision-Recall (PR) curve
 disp = PrecisionRecallDisplay(precision=precision, recall=recall, average_precision=AP)
 disp.plot()
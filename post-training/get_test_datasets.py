@@ -22,6 +22,7 @@ Authors: MAF and ChatGPT, November 2024
 """
 
 import os
+import errno
 import shutil
 import pandas as pd
 import argparse
@@ -71,33 +72,61 @@ def extract_old_subject_ids(csv_file, folder_path, dataset_filter=None):
     # Load the CSV file into a pandas DataFrame
     df = pd.read_csv(csv_file)
 
-    # Get the list of filenames in the directory
-    files_in_directory = os.listdir(folder_path)
+    # Build the new -> old subject ID lookup once (first occurrence wins, as before)
+    df = df.drop_duplicates(subset='new_subject_id', keep='first')
+    id_mapping = dict(zip(df['new_subject_id'].astype(str), df['old_subject_id'].astype(str)))
 
     # Initialize lists to store matched new_subject_ids and old_subject_ids
     matched_new_subject_ids = []
     matched_old_subject_ids = []
 
     # Iterate over the files in the directory
-    for file_name in files_in_directory:
-        if file_name.endswith('.nii.gz'):
-            # Extract the part between 'aseg_' and '.nii.gz', e.g., 'aseg_A005.nii.gz' -> 'A005'
-            new_subject_id = file_name.split('aseg_')[1].split('.nii.gz')[0]
-
-            # Check if we should filter by a specific dataset (if provided)
-            if dataset_filter and not new_subject_id.startswith(dataset_filter):
-                continue  # Skip this file if it doesn't match the filter
-
-            # Check if the new_subject_id exists in the 'new_subject_id' column
-            if new_subject_id in df['new_subject_id'].values:
-                # Find the corresponding old_subject_id
-                old_subject_id = df.loc[df['new_subject_id'] == new_subject_id, 'old_subject_id'].values[0]
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            file_name = entry.name
+            if file_name.endswith('.nii.gz'):
+                # Extract the part between 'aseg_' and '.nii.gz', e.g., 'aseg_A005.nii.gz' -> 'A005'
+                new_subject_id = file_name.split('aseg_')[1].split('.nii.gz')[0]
+
+                # Check if we should filter by a specific dataset (if provided)
+                if dataset_filter and not new_subject_id.startswith(dataset_filter):
+                    continue  # Skip this file if it doesn't match the filter
+
+                # Find the corresponding old_subject_id, if the new_subject_id is in the CSV
+                old_subject_id = id_mapping.get(new_subject_id)
+                if old_subject_id is None:
+                    continue
                 matched_new_subject_ids.append(new_subject_id)  # Store new_subject_id
                 matched_old_subject_ids.append(old_subject_id)  # Store corresponding old_subject_id
 
     return matched_new_subject_ids, matched_old_subject_ids
 
 
+# Function to copy one file in-kernel (reflink on Btrfs/XFS) when the platform allows it
+def copy_file(source_file, destination_file):
+    try:
+        with open(source_file, 'rb') as src, open(destination_file, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            # copy_file_range may copy fewer bytes than requested, so loop until done
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+    except AttributeError:
+        # No os.copy_file_range (non-Linux)
+        shutil.copy2(source_file, destination_file)
+        return
+    except OSError as e:
+        # Fall back only when the in-kernel copy is not supported here (e.g. across filesystems);
+        # real I/O errors such as ENOSPC or EACCES are raised
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+        shutil.copy2(source_file, destination_file)
+        return
+    shutil.copystat(source_file, destination_file)
+
+
 # Function to fetch files based on old_subject_ids, substring, and HCP flag
 def fetch_files(dataset_folder, new_subject_ids, old_subject_ids, substring, is_hcp, copy_to=None):
     # Check if --copy-to flag is provided
@@ -138,7 +167,7 @@ def fetch_files(dataset_folder, new_subject_ids, old_subject_ids, substring, is_
 
                 # Copy the file to the new subject folder
                 destination_file = os.path.join(subject_copy_folder, file_name)
-                shutil.copy2(source_file, destination_file)
+                copy_file(source_file, destination_file)
                 print(f"Copied {file_name} to {destination_file}")
 
 
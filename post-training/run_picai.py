@@ -1,7 +1,5 @@
 import argparse
 from picai_eval import Metrics, evaluate_folder
-import matplotlib.pyplot as plt
-from sklearn.metrics import PrecisionRecallDisplay, RocCurveDisplay
 
 def main():
     # Parse command-line arguments
@@ -10,6 +8,7 @@ def main():
     parser.add_argument("--path2gt", required=True, help="Path to the ground truth folder.")
     #parser.add_argument("--img_ext", type=str, help="Image file extension (default: .nii.gz).")
     parser.add_argument("--path2json", required=True, help="Path to save the metrics JSON file.")
+    parser.add_argument("--no-plots", action="store_true", help="Skip the PR/ROC/FROC plots (matplotlib and sklearn are then never imported).")
     args = parser.parse_args()
 
     # Run PICAI evaluation
@@ -54,7 +53,16 @@ def main():
     print('Lesion TPR:', lesion_trp)
     print('Lesion FPR:', lesion_fpr)
 
+    if args.no_plots:
+        return
+
     # Plotting section
+    # Plotting libraries are slow to import, so only load them once they are needed
+    import matplotlib
+    matplotlib.use("Agg")  # figures are never shown here, skip the GUI backend probe
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import PrecisionRecallDisplay, RocCurveDisplay
+
     # Precision-Recall (PR) curve
     disp = PrecisionRecallDisplay(precision=precision, recall=recall, average_precision=AP)
     disp.plot()
@@ -19,7 +19,14 @@ def load_label_map(filepath):
         affine = None
     elif filepath.endswith('.nii') or filepath.endswith('.nii.gz'):
         img = nib.load(filepath)
-        data = img.get_fdata().astype(np.int32)
+        # Read the stored labels without a float64 copy and keep the smallest integer type that fits
+        raw = np.asanyarray(img.dataobj)
+        # Both ends of the label range must fit (negative labels included)
+        min_label, max_label = raw.min(), raw.max()
+        for dtype in (np.int8, np.int16, np.int32):
+            if min_label >= np.iinfo(dtype).min and max_label <= np.iinfo(dtype).max:
+                break
+        data = raw.astype(dtype, copy=False)
         affine = img.affine
     else:
         raise ValueError(f"Unsupported file format: {filepath}")
@@ -31,7 +38,8 @@ def save_label_map(data, affine, output_path):
     if output_path.endswith('.npy'):
         np.save(output_path, data)
     elif output_path.endswith('.nii') or output_path.endswith('.nii.gz'):
-        img = nib.Nifti1Image(data.astype(np.int32), affine)
+        img = nib.Nifti1Image(data, affine)
+        img.set_data_dtype(data.dtype)
         nib.save(img, output_path)
     else:
         raise ValueError(f"Unsupported output format: {output_path}")
@@ -39,10 +47,16 @@ def save_label_map(data, affine, output_path):
 def merge_label_maps(ref_data, src_data, label_value):
     """Merge the specified label from src_data into ref_data where ref_data is zero."""
     print(f"Merging label {label_value} from source into reference map...")
-    mask = (src_data == label_value) & (ref_data == 0)
-    merged = ref_data.copy()
-    merged[mask] = label_value
-    print(f"Number of voxels added: {np.sum(mask)}")
+    # Combine the two conditions in place in one boolean buffer
+    mask = src_data == label_value
+    mask &= ref_data == 0
+    # Widen the copy only if label_value does not fit the reference type (e.g. label 200 into an int8 map)
+    dtype = ref_data.dtype
+    if dtype.kind in "iu" and not np.iinfo(dtype).min <= label_value <= np.iinfo(dtype).max:
+        dtype = np.promote_types(dtype, np.min_scalar_type(label_value))
+    merged = ref_data.astype(dtype)
+    np.putmask(merged, mask, label_value)
+    print(f"Number of voxels added: {np.count_nonzero(mask)}")
     return merged
 
 def main():
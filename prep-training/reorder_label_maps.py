@@ -1,9 +1,18 @@
 import os
 import json
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import nibabel as nib
 import numpy as np
 
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    # numba is optional: remap_labels then falls back to np.searchsorted
+    njit = None
+    prange = range
+
 def main():
     # Argument parser
     parser = argparse.ArgumentParser(description="Process and rename label maps in a directory.")
@@ -15,6 +24,7 @@ def main():
     parser.add_argument('--json_name', type=str, required=False, default="aseg2linear", help="Suffix for the JSON label conversion files.")
     parser.add_argument('--all2one', action='store_true', help="If set, all labels except 0 are set to 1.")
     parser.add_argument('--recursive', action='store_true', help="If set, process subdirectories recursively.")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Number of label maps processed in parallel (default: number of CPU cores).")
     parser.add_argument('--label_map_id', default="_LYM_label.nii.gz", choices=["_LYM_label.nii.gz", "aseg.nii.gz", "Segmentation.nii.gz"], help="Pattern to extract the correct label map file from the filenames.")
     args = parser.parse_args()
 
@@ -33,8 +43,9 @@ def main():
     print(f"Label map ID: {args.label_map_id}")
     print(f"All-to-one mode: {args.all2one}")
     print(f"Recursive mode: {args.recursive}")
+    print(f"Parallel jobs: {args.jobs}")
 
-    process_directory(args.input_dir, args.output_dir, args.json_name, args.mapping_dir, args.all2one, args.recursive, args.label_map_id)
+    process_directory(args.input_dir, args.output_dir, args.json_name, args.mapping_dir, args.all2one, args.recursive, args.label_map_id, args.jobs)
     print("Done processing label values and saving label mappings.")
 
 def save_labels(mapping, json_name, mapping_dir, file_basename):
@@ -47,37 +58,84 @@ def save_labels(mapping, json_name, mapping_dir, file_basename):
         json.dump(mapping, mapping_file)
     print(f"Labels conversion saved to {mapping_file_path}")
 
+# Largest label value for which remap_labels builds a dense lookup table
+MAX_LUT_LABEL = 2 ** 16
+
+def searchsorted_remap(flat_in, keys, flat_out):
+    """Writes the index of each flat_in value in the sorted keys into flat_out (single parallel pass)."""
+    for i in prange(flat_in.size):
+        flat_out[i] = np.searchsorted(keys, flat_in[i])
+
+if njit is not None:
+    searchsorted_remap = njit(parallel=True, cache=True)(searchsorted_remap)
+
+def find_unique_labels(data):
+    """Sorted unique values of data, from a histogram (one linear pass, no sort) when the labels allow it."""
+    if data.size and data.min() >= 0 and data.max() <= MAX_LUT_LABEL:
+        return np.flatnonzero(np.bincount(data.ravel(order='K'))).astype(data.dtype)
+    # Negative or very large labels
+    return np.unique(data)
+
+def remap_labels(data, unique_labels):
+    """Replaces every voxel by the index of its value in the sorted unique_labels."""
+    new_labels = np.arange(len(unique_labels), dtype=np.int32)
+    if unique_labels[0] >= 0 and unique_labels[-1] <= MAX_LUT_LABEL:
+        # Dense lookup table indexed by the old label
+        lut = np.zeros(unique_labels[-1] + 1, dtype=np.int32)
+        lut[unique_labels] = new_labels
+        # np.take skips the generic advanced-indexing machinery of lut[data];
+        # every value of data is in unique_labels, so clipping skips the bounds check without changing the result
+        return np.take(lut, data, mode='clip')
+    # Negative or very large labels: binary search in the sorted labels instead
+    if njit is None:
+        return np.take(new_labels, np.searchsorted(unique_labels, data), mode='clip')
+    # Walk both volumes in their memory order so the flat views need no copy
+    order = 'F' if data.flags.f_contiguous and not data.flags.c_contiguous else 'C'
+    data = np.asarray(data, order=order)
+    new_data = np.empty(data.shape, dtype=np.int32, order=order)
+    searchsorted_remap(data.ravel(order=order), unique_labels, new_data.ravel(order=order))
+    return new_data
+
 def process_label_map(file_path, output_dir, json_name, mapping_dir=None, all2one=False, input_dir=None):
 
     # Load the label map file
     img = nib.load(file_path)
-    data = img.get_fdata()
+    # Read the stored values directly (no float64 copy for integer label maps)
+    data = np.asanyarray(img.dataobj)
 
     # Ensure the data is handled as integer
-    data = np.round(data).astype(np.int32)  # Round and convert to integer
+    if data.dtype.kind == 'f':
+        data = np.rint(data).astype(np.int32)  # Round and convert to integer
+    else:
+        data = data.astype(np.int32, copy=False)
 
     # Debug: print the shape and data type of the loaded image
     print(f"Loaded {file_path}, shape: {data.shape}, dtype: {data.dtype}")
 
+    # Keep only the metadata: drop the image (and any cached array) before allocating the remapped volume
+    affine = img.affine
+    header = img.header
+    img.uncache()
+    del img
+
     if all2one:
-        # Get unique labels and create a mapping
-        unique_labels = list(map(int, np.unique(data)))  # Convert to standard Python integers
-        label_map = {old: (1 if old != 0 else 0) for old in unique_labels}
-        # If all2one is enabled, map all labels except 0 to 1
-        new_data = np.where(data > 0, 1, 0)
+        # Binary output: no need to scan for the unique labels
+        label_map = {0: 0, 1: 1}
+        # If all2one is enabled, map all labels except 0 to 1, written straight into a uint8 buffer
+        new_data = np.greater(data, 0, out=np.empty(data.shape, dtype=np.uint8))
+        header = header.copy()
+        header.set_data_dtype(np.uint8)
         print(f"All-to-one mode enabled. All labels except 0 are set to 1.")
     else:
-        # Get unique labels and create a mapping
-        unique_labels = list(map(int, np.unique(data)))  # Convert to standard Python integers
-        label_map = {old: new for new, old in enumerate(unique_labels)}
+        # Get unique labels (sorted) and create a mapping
+        unique_labels = find_unique_labels(data)
+        label_map = {int(old): new for new, old in enumerate(unique_labels)}  # Standard Python integers
 
         # Debug: print the unique labels and the label map
-        print(f"Unique labels in {file_path}: {unique_labels}")
+        print(f"Unique labels in {file_path}: {list(label_map)}")
 
-        # Map the old labels to new labels
-        new_data = np.copy(data)
-        for old_label, new_label in label_map.items():
-            new_data[data == old_label] = new_label
+        # Map the old labels to new labels in a single pass over the volume
+        new_data = remap_labels(data, unique_labels)
 
     # Extract the base name for saving mappings
     file_basename = os.path.basename(file_path).replace('.nii.gz', '')
@@ -87,26 +145,41 @@ def process_label_map(file_path, output_dir, json_name, mapping_dir=None, all2on
         save_labels(label_map, json_name, mapping_dir, file_basename)
 
     # Save the new label map file
-    new_img = nib.Nifti1Image(new_data, img.affine, img.header)
+    new_img = nib.Nifti1Image(new_data, affine, header)
     new_file_path = os.path.join(output_dir, os.path.relpath(file_path, start=input_dir))
     os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
     nib.save(new_img, new_file_path)
     print(f"Processed {file_path} -> {new_file_path}")
 
-def process_directory(input_dir, output_dir, json_name, mapping_dir=None, all2one=False, recursive=False, label_map_id="_LYM_label.nii.gz"):
+def init_worker(jobs):
+    """Splits the cores between worker processes so numba's parallel threads do not oversubscribe them."""
+    if njit is not None:
+        numba.set_num_threads(max(1, (os.cpu_count() or 1) // jobs))
+
+def process_directory(input_dir, output_dir, json_name, mapping_dir=None, all2one=False, recursive=False, label_map_id="_LYM_label.nii.gz", jobs=None):
     # Ensure the output and mapping directories exist
     os.makedirs(output_dir, exist_ok=True)
     if mapping_dir:
         os.makedirs(mapping_dir, exist_ok=True)
 
     # Walk through the directory
+    file_paths = []
     for root, _, files in os.walk(input_dir):
         for filename in files:
             if label_map_id in filename and filename.endswith('.nii.gz'):
-                file_path = os.path.join(root, filename)
-                process_label_map(file_path, output_dir, json_name, mapping_dir, all2one, input_dir=input_dir)
+                file_paths.append(os.path.join(root, filename))
         if not recursive:
             break
 
+    # Each label map is independent (load -> remap -> save), so process them in parallel
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(jobs,)) as executor:
+        futures = [
+            executor.submit(process_label_map, file_path, output_dir, json_name, mapping_dir, all2one, input_dir=input_dir)
+            for file_path in file_paths
+        ]
+        for future in futures:
+            future.result()
+
 if __name__ == "__main__":
     main()
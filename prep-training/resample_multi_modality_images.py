@@ -1,22 +1,49 @@
 import os
+import json
 import argparse
 import SimpleITK as sitk
 import numpy as np
 import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-def resample_image(ref_img_path, target_img_path, output_path, is_label_map=False):
+INTEGER_PIXEL_IDS = (
+    sitk.sitkUInt8, sitk.sitkInt8, sitk.sitkUInt16, sitk.sitkInt16,
+    sitk.sitkUInt32, sitk.sitkInt32, sitk.sitkUInt64, sitk.sitkInt64,
+)
+
+def looks_like_label_map(img):
+    """Integer image with values in [0, 255]: a mask/label map rather than an MR/PET intensity image."""
+    if img.GetPixelID() not in INTEGER_PIXEL_IDS:
+        return False
+    min_max = sitk.MinimumMaximumImageFilter()
+    min_max.Execute(img)
+    return min_max.GetMinimum() >= 0 and min_max.GetMaximum() <= 255
+
+def resample_image(ref_img_path, target_img_path, output_path, is_label_map=None, quantize=False):
 
     """Resamples target image to match the matrix size and spacing of reference image using SimpleITK."""
     print(f"[INFO] Starting resampling process...")
 
-    ref_img = sitk.ReadImage(ref_img_path)
+    # Only the reference geometry is needed: read the header, not the (compressed) voxel data
+    ref_reader = sitk.ImageFileReader()
+    ref_reader.SetFileName(ref_img_path)
+    ref_reader.ReadImageInformation()
     target_img = sitk.ReadImage(target_img_path)
 
-    print(f"[INFO] Reference image shape: {ref_img.GetSize()}")
+    print(f"[INFO] Reference image shape: {ref_reader.GetSize()}")
     print(f"[INFO] Target image shape before resampling: {target_img.GetSize()}")
 
     resampler = sitk.ResampleImageFilter()
-    resampler.SetReferenceImage(ref_img)
+    resampler.SetSize(ref_reader.GetSize())
+    resampler.SetOutputSpacing(ref_reader.GetSpacing())
+    resampler.SetOutputOrigin(ref_reader.GetOrigin())
+    resampler.SetOutputDirection(ref_reader.GetDirection())
+
+    if is_label_map is None:
+        # Not specified: nearest neighbor is far cheaper than BSpline, and the right choice for masks
+        is_label_map = looks_like_label_map(target_img)
+        if is_label_map:
+            print(f"[INFO] Target image looks like a label map (integer values in [0, 255]).")
 
     if is_label_map:
         # Use nearest neighbor interpolation for label maps to preserve integer values
@@ -26,62 +53,116 @@ def resample_image(ref_img_path, target_img_path, output_path, is_label_map=Fals
         # Use cubic interpolation for continuous images
         print(f"[INFO] Using cubic interpolation for continuous image.")
         resampler.SetInterpolator(sitk.sitkBSpline)
+        if target_img.GetPixelID() in INTEGER_PIXEL_IDS:
+            # Interpolate in float so the result can be rounded (not truncated) back to the input type
+            resampler.SetOutputPixelType(sitk.sitkFloat32)
 
     resampled_target_img = resampler.Execute(target_img)
 
+    if not is_label_map and target_img.GetPixelID() in INTEGER_PIXEL_IDS:
+        # Restore the original integer type (BSpline overshoot is clamped to its range)
+        resampled_target_img = sitk.Clamp(sitk.Round(resampled_target_img), target_img.GetPixelID())
+    elif quantize and not is_label_map:
+        resampled_target_img = quantize_to_int16(resampled_target_img, output_path)
+
     print(f"[INFO] Target image shape after resampling: {resampled_target_img.GetSize()}")
-    sitk.WriteImage(resampled_target_img, output_path)
+    # Fastest gzip level: outputs are intermediate files for nnU-Net, write time matters more than size
+    sitk.WriteImage(resampled_target_img, output_path, useCompression=True, compressionLevel=1)
     print(f"[INFO] Resampled: {os.path.basename(target_img_path)} -> {os.path.basename(output_path)}")
 
-def find_matching_file(directory, substring):
-    """Finds a file in the directory that contains the given substring."""
-    for filename in os.listdir(directory):
-        if substring in filename and filename.endswith(".nii.gz"):
-            return os.path.join(directory, filename)
-    return None
+def quantize_to_int16(img, output_path):
+    """
+    Linearly rescales a float image to [0, 32767] and casts it to int16 (half the bytes to gzip and store).
+    The scale and offset to recover the original values (value * scale + offset) are saved next to the output.
+    """
+    min_max = sitk.MinimumMaximumImageFilter()
+    min_max.Execute(img)
+    minimum, maximum = min_max.GetMinimum(), min_max.GetMaximum()
+    scale = (maximum - minimum) / 32767 if maximum > minimum else 1.0
+
+    quantized_img = sitk.Cast(sitk.Round((img - minimum) / scale), sitk.sitkInt16)
+
+    sidecar_path = output_path.replace(".nii.gz", "") + "_int16_scaling.json"
+    with open(sidecar_path, "w") as f:
+        json.dump({"scale": scale, "offset": minimum}, f, indent=4)
+    print(f"[INFO] Quantized to int16 (scale={scale}, offset={minimum}), saved scaling to {os.path.basename(sidecar_path)}")
+    return quantized_img
+
+def find_matching_files(directory, ref_substring, target_substring):
+    """Finds the reference and target files (first .nii.gz containing each substring) with a single directory scan."""
+    with os.scandir(directory) as entries:
+        nii_files = [(e.name, e.path) for e in entries if e.name.endswith(".nii.gz")]
+    ref_img_path = next((path for name, path in nii_files if ref_substring in name), None)
+    target_img_path = next((path for name, path in nii_files if target_substring in name), None)
+    return ref_img_path, target_img_path
+
+def copy_reference(ref_img_path, ref_output_path):
+    """Copies the reference image to the output directory, unless it is already there."""
+    ref_name = os.path.basename(ref_img_path)
+    if os.path.abspath(ref_img_path) != os.path.abspath(ref_output_path):
+        shutil.copy(ref_img_path, ref_output_path)
+        print(f"[INFO] Copied reference image: {ref_name} -> {ref_name}")
+    else:
+        print(f"[INFO] Skipping copy as source and destination are the same: {ref_name}")
 
-def process_directory(input_dir, output_dir, ref_substring, resample_substring, process_method, single_dir=False, is_label_map=False):
+def init_worker(jobs):
+    """Splits the cores between worker processes so SimpleITK's own threads do not oversubscribe them."""
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(max(1, (os.cpu_count() or 1) // jobs))
 
-    """Processes the input directory, handling both subdirectories and single directory cases."""
-    if not single_dir and any(os.path.isdir(os.path.join(input_dir, d)) for d in os.listdir(input_dir)):
-        
-        # Case: Input directory contains subdirectories
-        subdirs = sorted([d for d in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, d))])
+def process_subject(input_dir, output_dir, sub, ref_substring, resample_substring, process_method, is_label_map=None, quantize=False):
+    """Processes one subject subdirectory: copies the reference image and resamples the target image."""
+    sub_path = os.path.join(input_dir, sub)
+    output_sub_path = os.path.join(output_dir, sub)
+    os.makedirs(output_sub_path, exist_ok=True)  # Ensure output directory exists
 
-        for sub in subdirs:
-            sub_path = os.path.join(input_dir, sub)
-            output_sub_path = os.path.join(output_dir, sub)
-            os.makedirs(output_sub_path, exist_ok=True)  # Ensure output directory exists
+    print(f"[INFO] Processing subject: {sub}")
+    print(f"[INFO] Selected process: {process_method}")
 
-            print(f"[INFO] Processing subject: {sub}")
-            print(f"[INFO] Selected process: {process_method}")
+    # Find reference and target images
+    ref_img_path, target_img_path = find_matching_files(sub_path, ref_substring, resample_substring)
 
-            # Find reference and target images
-            ref_img_path = find_matching_file(sub_path, ref_substring)
-            target_img_path = find_matching_file(sub_path, resample_substring)
+    if not ref_img_path or not target_img_path:
+        print(f"[WARNING] Skipping {sub} (missing ref or target images)")
+        return
 
-            if not ref_img_path or not target_img_path:
-                print(f"[WARNING] Skipping {sub} (missing ref or target images)")
-                continue
+    ref_output_path = os.path.join(output_sub_path, os.path.basename(ref_img_path))
+    # Define output file name for the resampled image
+    output_path = os.path.join(output_sub_path, os.path.basename(target_img_path))
 
-            # Copy reference image to output directory
-            ref_output_path = os.path.join(output_sub_path, os.path.basename(ref_img_path))
-            if os.path.abspath(ref_img_path) != os.path.abspath(ref_output_path):
-                shutil.copy(ref_img_path, ref_output_path)
-                print(f"[INFO] Copied reference image: {os.path.basename(ref_img_path)} -> {os.path.basename(ref_output_path)}")
-            else:
-                print(f"[INFO] Skipping copy as source and destination are the same: {os.path.basename(ref_img_path)}")
+    with ThreadPoolExecutor(max_workers=1) as io_executor:
+        # Copy reference image to output directory in the background (disk-bound) while the target is resampled
+        copy_future = io_executor.submit(copy_reference, ref_img_path, ref_output_path)
 
-            # Define output file name for the resampled image
-            output_path = os.path.join(output_sub_path, os.path.basename(target_img_path))
+        if process_method == "resample":
+            resample_image(ref_img_path, target_img_path, output_path, is_label_map, quantize)
+        elif process_method == "coregister":
+            print(f"[WARNING] Coregistration option is not yet implemented for {sub}")
+        else:
+            print(f"[ERROR] Invalid process method: {process_method}")
+
+        copy_future.result()
+
+def process_directory(input_dir, output_dir, ref_substring, resample_substring, process_method, single_dir=False, is_label_map=None, jobs=None, quantize=False):
+
+    """Processes the input directory, handling both subdirectories and single directory cases."""
+    jobs = jobs or os.cpu_count() or 1
+    # One directory scan; DirEntry.is_dir() is answered from the listing itself on most filesystems
+    with os.scandir(input_dir) as entries:
+        subdirs = sorted(e.name for e in entries if e.is_dir())
+
+    if not single_dir and subdirs:
+        
+        # Case: Input directory contains subdirectories
+
+        # Subjects are independent, so process them in parallel
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(jobs,)) as executor:
+            futures = [
+                executor.submit(process_subject, input_dir, output_dir, sub, ref_substring, resample_substring, process_method, is_label_map, quantize)
+                for sub in subdirs
+            ]
+            for future in futures:
+                future.result()
 
-            if process_method == "resample":
-                resample_image(ref_img_path, target_img_path, output_path, is_label_map)
-            elif process_method == "coregister":
-                print(f"[WARNING] Coregistration option is not yet implemented for {sub}")
-            else:
-                print(f"[ERROR] Invalid process method: {process_method}")
-   
     else:
         # Case: Input directory contains only files or single_dir flag is set
         os.makedirs(output_dir, exist_ok=True)  # Ensure output directory exists
@@ -90,30 +171,28 @@ def process_directory(input_dir, output_dir, ref_substring, resample_substring,
         print(f"[INFO] Selected process: {process_method}")
 
         # Find reference and target images
-        ref_img_path = find_matching_file(input_dir, ref_substring)
-        target_img_path = find_matching_file(input_dir, resample_substring)
+        ref_img_path, target_img_path = find_matching_files(input_dir, ref_substring, resample_substring)
 
         if not ref_img_path or not target_img_path:
             print(f"[WARNING] Skipping processing (missing ref or target images)")
             return
 
-        # Copy reference image to output directory
         ref_output_path = os.path.join(output_dir, os.path.basename(ref_img_path))
-        if os.path.abspath(ref_img_path) != os.path.abspath(ref_output_path):
-            shutil.copy(ref_img_path, ref_output_path)
-            print(f"[INFO] Copied reference image: {os.path.basename(ref_img_path)} -> {os.path.basename(ref_output_path)}")
-        else:
-            print(f"[INFO] Skipping copy as source and destination are the same: {os.path.basename(ref_img_path)}")
-
         # Define output file name for the resampled image
         output_path = os.path.join(output_dir, os.path.basename(target_img_path))
 
-        if process_method == "resample":
-            resample_image(ref_img_path, target_img_path, output_path, is_label_map)
-        elif process_method == "coregister":
-            print(f"[WARNING] Coregistration option is not yet implemented")
-        else:
-            print(f"[ERROR] Invalid process method: {process_method}")
+        with ThreadPoolExecutor(max_workers=1) as io_executor:
+            # Copy reference image to output directory in the background (disk-bound) while the target is resampled
+            copy_future = io_executor.submit(copy_reference, ref_img_path, ref_output_path)
+
+            if process_method == "resample":
+                resample_image(ref_img_path, target_img_path, output_path, is_label_map, quantize)
+            elif process_method == "coregister":
+                print(f"[WARNING] Coregistration option is not yet implemented")
+            else:
+                print(f"[ERROR] Invalid process method: {process_method}")
+
+            copy_future.result()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process images for nnU-Net preprocessing.")
@@ -123,8 +202,10 @@ if __name__ == "__main__":
     parser.add_argument("--resample_modality", type=str, required=True, help="Substring to identify modality to be resampled (e.g., '0001' for T2w).")
     parser.add_argument("--process", type=str, choices=["resample", "coregister"], required=True, help="Processing method: 'resample' (default) or 'coregister'.")
     parser.add_argument("--single_dir", action="store_true", help="Flag to indicate that the input directory contains only files (no subdirectories).")
-    parser.add_argument("--is_label_map", action="store_true", help="Specify whether the file to resample is a label map. If so, nearest neighbor interpolation will be used instead of cubic spline interpolation.")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of subjects processed in parallel (default: number of CPU cores).")
+    parser.add_argument("--quantize", action="store_true", help="Store resampled float images as int16 (linear rescale to [0, 32767]); the scale and offset are saved in a JSON file next to each output.")
+    parser.add_argument("--is_label_map", action=argparse.BooleanOptionalAction, default=None, help="Specify whether the file to resample is a label map. If so, nearest neighbor interpolation will be used instead of cubic spline interpolation. If neither --is_label_map nor --no-is_label_map is given, integer images with values in [0, 255] are treated as label maps.")
     
     args = parser.parse_args()
     output_directory = args.output_dir if args.output_dir else args.input_dir  # Default to input_dir if not provided
-    process_directory(args.input_dir, output_directory, args.ref_modality, args.resample_modality, args.process, args.single_dir, args.is_label_map)
+    process_directory(args.input_dir, output_directory, args.ref_modality, args.resample_modality, args.process, args.single_dir, args.is_label_map, args.jobs, args.quantize)
@@ -1,10 +1,21 @@
 import os
+import math
+import errno
+import hashlib
 import shutil
+import tarfile
+import subprocess
 import argparse
-import pandas as pd
-from sklearn.model_selection import train_test_split
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import json
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional: the subject lists are then written with the json module
+    orjson = None
+
 # Main function to handle arguments
 def main():
     parser = argparse.ArgumentParser(description='Split dataset into train and test sets.')
@@ -17,6 +28,8 @@ def main():
     parser.add_argument('-te', '--test', type=str, help="Path to the output test directory (default: 'test' subdir of input directory)")
     # Argument for test size
     parser.add_argument('-s', '--split', type=float, default=0.15, help='Test set size (default: 0.15 for 85%% train, 15%% test)')
+    # How subjects are assigned to train/test
+    parser.add_argument('--split-method', choices=['random', 'hash'], default='random', help="'random' (default): seeded shuffle of all subjects; 'hash': each subject goes to test if the hash of its name falls below the test size (stable across runs, machines and added subjects)")
     # Optional flag for no subdirectories (if subjects are files)
     parser.add_argument('--no-subdirs', action='store_true', help='Use this flag if the subjects are files and not in individual subdirectories')
     # Flag to save JSON files with subject IDs
@@ -27,10 +40,29 @@ def main():
     parser.add_argument('--dataset-named-json', action='store_true', help='Use dataset-specific names for the JSON files')
     # Flag to skip file/directory moving or copying
     parser.add_argument('--skip-copy', action='store_true', help='Skip the file/directory moving or copying process')
+    # Flag to only compute the split, without touching the filesystem
+    parser.add_argument('--dry-run', action='store_true', help='Compute and print the train/test split only: no directories created, nothing copied and no JSON files written')
+    # Flag to resume an interrupted run
+    parser.add_argument('--resume', action='store_true', help='Skip subjects already fully copied to the train/test directories (same files and sizes); incomplete copies are redone')
+    # Flag to print every detected subject
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the IDs of all detected subjects (by default only their number is printed)')
+    # Optional packing of the subjects into tar shards
+    parser.add_argument('--shard-size-mb', type=int, help='Instead of copying subjects one by one, pack them into tar shards of about this size (e.g., 128) in the train/test directories, with a manifest.json listing the subject IDs of each shard (not combinable with --link or --resume)')
+    # How subjects are placed in the train/test directories
+    parser.add_argument('--link', '--link-mode', dest='link', choices=['copy', 'tar', 'hardlink', 'reflink', 'symlink'], default='copy', help="How to place subjects in the train/test directories: 'copy' (default), 'tar' (copy subject directories through a 'tar | tar' pipe, faster for many small files), 'hardlink' (no data copied, falls back to copy across filesystems), 'reflink' (copy-on-write clone via copy_file_range on XFS/Btrfs, plain copy elsewhere) or 'symlink' (one absolute symlink per subject)")
+
+    # Number of subjects copied in parallel
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='Number of subjects copied/linked in parallel (default: 8)')
 
     # Parse the arguments
     args = parser.parse_args()
 
+    # Shards are written from scratch: there is no per-subject placement to link or resume
+    if args.shard_size_mb and args.link != 'copy':
+        parser.error("--link cannot be combined with --shard-size-mb")
+    if args.shard_size_mb and args.resume:
+        parser.error("--resume cannot be combined with --shard-size-mb")
+
     # Set default values for train, test directories, and JSON path if not provided
     train_dir = args.train if args.train else os.path.join(args.input, 'train')
     test_dir = args.test if args.test else os.path.join(args.input, 'test')
@@ -46,68 +78,248 @@ def main():
         save_json=args.save_json,
         json_path=json_path,
         dataset_named_json=args.dataset_named_json,
-        skip_copy=args.skip_copy
+        skip_copy=args.skip_copy,
+        resume=args.resume,
+        shard_size_mb=args.shard_size_mb,
+        verbose=args.verbose,
+        dry_run=args.dry_run,
+        link=args.link,
+        split_method=args.split_method,
+        jobs=args.jobs
     )
 
-def split_dataset(base_dir, train_dir, test_dir, test_size=0.15, no_subdirs=False, save_json=False, json_path='', dataset_named_json=False, skip_copy=False):
+def save_json_file(data, path):
+    """Write data to a JSON file, with orjson when it is installed."""
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data))
+    else:
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+def hash_split(names, test_size, seed=42):
+    """Yield (name, is_test) pairs; a subject is in test if the hash of its name maps below test_size in [0, 1)."""
+    for name in names:
+        digest = hashlib.blake2b(f"{seed}:{name}".encode(), digest_size=8).digest()
+        yield name, int.from_bytes(digest, 'big') / 2**64 < test_size
+
+def link_or_copy_file(src, dst):
+    """Hard-link src to dst, or copy it if both are not on the same filesystem."""
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy(src, dst)
+
+# copy_file_range errors that only mean "no in-kernel copy here" (other filesystem, old kernel, unsupported file)
+REFLINK_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL)
+
+def reflink_or_copy_file(src, dst):
+    """Clone src to dst with os.copy_file_range (shared extents on XFS/Btrfs); plain copy where it is unavailable."""
+    if not hasattr(os, 'copy_file_range'):
+        shutil.copy(src, dst)
+        return
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            offset = 0
+            while offset < size:
+                # Short copies are allowed; 0 means the source ended early
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+    except OSError as e:
+        # Real I/O errors (ENOSPC, EACCES, ...) are raised, not retried
+        if e.errno not in REFLINK_UNSUPPORTED_ERRNOS:
+            raise
+        shutil.copy(src, dst)
+        return
+    shutil.copymode(src, dst)
+
+def tar_copy_tree(src, dst):
+    """Copy the directory src to dst through a 'tar -cf - | tar -xf -' pipe (the tree walk happens in tar, not Python)."""
+    os.makedirs(dst)
+    pack = subprocess.Popen(['tar', '-C', src, '-cf', '-', '.'], stdout=subprocess.PIPE)
+    unpack = subprocess.run(['tar', '-C', dst, '-xf', '-'], stdin=pack.stdout)
+    pack.stdout.close()
+    if pack.wait() != 0 or unpack.returncode != 0:
+        raise subprocess.CalledProcessError(pack.returncode or unpack.returncode, f"tar copy of {src} to {dst}")
+
+def tree_file_sizes(root):
+    """Map each file under root (relative path) to its size."""
+    sizes = {}
+    for dirpath, _, files in os.walk(root):
+        for f in files:
+            path = os.path.join(dirpath, f)
+            sizes[os.path.relpath(path, root)] = os.path.getsize(path)
+    return sizes
+
+def is_copied(src, dst):
+    """True if dst already holds a complete copy (or link) of the subject src."""
+    if os.path.islink(dst):
+        return os.path.realpath(dst) == os.path.realpath(src)
+    if os.path.isfile(src):
+        return os.path.isfile(dst) and os.path.getsize(dst) == os.path.getsize(src)
+    return os.path.isdir(dst) and tree_file_sizes(dst) == tree_file_sizes(src)
+
+def write_shards(base_dir, subjects, subject_ids, out_dir, shard_size_mb):
+    """
+    Pack the subjects (files or subdirectories of base_dir) into tar shards of about shard_size_mb in out_dir.
+    A subject is never split across shards; manifest.json maps each shard to the IDs of its subjects.
+    """
+    shard_size = shard_size_mb * 1024 * 1024
+    manifest = {}
+    tar = None
+    current_size = 0
+    for subject, subject_id in zip(subjects, subject_ids):
+        src = os.path.join(base_dir, subject)
+        size = os.path.getsize(src) if os.path.isfile(src) else sum(tree_file_sizes(src).values())
+        # Start a new shard when this subject would overflow the current one
+        if tar is None or (current_size > 0 and current_size + size > shard_size):
+            if tar is not None:
+                tar.close()
+            shard_name = f'shard-{len(manifest):06d}.tar'
+            tar = tarfile.open(os.path.join(out_dir, shard_name), 'w')
+            manifest[shard_name] = []
+            current_size = 0
+        tar.add(src, arcname=subject)
+        manifest[shard_name].append(subject_id)
+        current_size += size
+    if tar is not None:
+        tar.close()
+
+    save_json_file(manifest, os.path.join(out_dir, 'manifest.json'))
+    print(f"Packed {len(subjects)} subjects into {len(manifest)} shards in {out_dir}")
+
+def copy_subject(src, dst, no_subdirs=False, link='copy', resume=False):
+    """Place one subject (file or subdirectory) at dst by copying, hard-linking, reflinking or symlinking it."""
+    if resume and os.path.lexists(dst):
+        if is_copied(src, dst):
+            print(f"Skipping {os.path.basename(dst)}: already copied")
+            return
+        # Left over from an interrupted run: start this subject again
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        else:
+            os.remove(dst)
+
+    if link == 'symlink':
+        os.symlink(os.path.abspath(src), dst, target_is_directory=not no_subdirs)
+    elif link == 'reflink':
+        if no_subdirs:
+            reflink_or_copy_file(src, dst)
+        else:
+            shutil.copytree(src, dst, copy_function=reflink_or_copy_file)
+    elif link == 'hardlink':
+        if no_subdirs:
+            link_or_copy_file(src, dst)
+        else:
+            shutil.copytree(src, dst, copy_function=link_or_copy_file)
+    elif link == 'tar' and not no_subdirs:
+        tar_copy_tree(src, dst)
+    else:
+        if no_subdirs:
+            shutil.copy(src, dst)
+        else:
+            shutil.copytree(src, dst)
+
+def split_dataset(base_dir, train_dir, test_dir, test_size=0.15, no_subdirs=False, save_json=False, json_path='', dataset_named_json=False, skip_copy=False, link='copy', split_method='random', jobs=8, resume=False, shard_size_mb=None, verbose=False, dry_run=False):
+    """Splits the subjects of base_dir into train/test sets; returns {'train': [subject IDs], 'test': [subject IDs]}."""
+    if not 0 <= test_size <= 1:
+        raise ValueError(f"test_size={test_size} should be in the [0, 1] range.")
+
+    if dry_run:
+        # Nothing is written: no directories, copies or JSON files
+        skip_copy = True
+        save_json = False
+
     # Create train and test directories if they don't exist
     if not skip_copy:
         os.makedirs(train_dir, exist_ok=True)
         os.makedirs(test_dir, exist_ok=True)
 
+    # Single directory scan; DirEntry answers is_file()/is_dir() from the listing itself
+    # Case 1: each subject is in its own subdirectory; Case 2 (no_subdirs): subject files are directly in base_dir
+    with os.scandir(base_dir) as entries:
+        all_subjects = [e.name for e in entries if (e.is_file() if no_subdirs else e.is_dir())]
+
     if no_subdirs:
-        # Case 2: All subject files are directly in the base_dir (no subdirectories)
-        all_subjects = [f for f in os.listdir(base_dir) if os.path.isfile(os.path.join(base_dir, f))]
+        # Subject ID = file name without the .nii.gz extension
         subject_ids = [d.rsplit('.nii.gz', 1)[0] if d.endswith('.nii.gz') else d for d in all_subjects]
-        print("Subjects detected in the dataset: ", subject_ids)
-
-        def extract_subject_id(filename):
-            if filename.endswith('.nii.gz'):
-                return filename.rsplit('.nii.gz', 1)[0]  # Remove the extension
-            return filename  # Fallback to the original filename if it doesn't match the pattern
-
     else:
-        # Case 1: Each subject is in its own subdirectory
-        all_subjects = [d for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d))]
-        subject_ids = [d.rsplit('.nii.gz', 1)[0] if d.endswith('.nii.gz') else d for d in all_subjects]
+        # Subject ID = subdirectory name
+        subject_ids = all_subjects
+    # Printing the whole list is slow and unreadable for large cohorts, so only on request
+    if verbose:
         print("Subjects detected in the dataset: ", subject_ids)
+    else:
+        print(f"Subjects detected in the dataset: {len(subject_ids)} (use --verbose to list them)")
 
-    # Handle cases where test_size is 0 or 1
+    # Split subject indices, so subjects and their IDs are selected together
     if test_size == 0:
-        train_subjects = all_subjects
-        test_subjects = []
+        train_idx = range(len(all_subjects))
+        test_idx = []
     elif test_size == 1:
-        train_subjects = []
-        test_subjects = all_subjects
+        train_idx = []
+        test_idx = range(len(all_subjects))
+    elif split_method == 'hash':
+        # One pass, no shuffle: each subject's assignment depends only on its own name
+        train_idx, test_idx = [], []
+        for i, (subject, is_test) in enumerate(hash_split(all_subjects, test_size)):
+            (test_idx if is_test else train_idx).append(i)
     else:
-        # Split the subjects into train and test
-        train_subjects, test_subjects = train_test_split(all_subjects, test_size=test_size, random_state=42)
+        # Split the subjects into train and test, with the same permutation as
+        # sklearn's train_test_split(random_state=42) so existing splits are unchanged
+        n_test = math.ceil(test_size * len(all_subjects))
+        permutation = np.random.RandomState(42).permutation(len(all_subjects))
+        test_idx = permutation[:n_test]
+        train_idx = permutation[n_test:]
+
+    if 0 < test_size < 1 and (len(train_idx) == 0 or len(test_idx) == 0):
+        raise ValueError(
+            f"With {len(all_subjects)} subjects and test_size={test_size}, the resulting "
+            f"{'train' if len(train_idx) == 0 else 'test'} set would be empty. Adjust test_size or add subjects."
+        )
 
+    # Gather with NumPy indexing (keeps the split order) instead of per-element Python loops
+    train_idx = np.asarray(train_idx, dtype=np.intp)
+    test_idx = np.asarray(test_idx, dtype=np.intp)
+    subjects_array = np.asarray(all_subjects, dtype=object)
+    ids_array = np.asarray(subject_ids, dtype=object)
+    train_subjects = subjects_array[train_idx].tolist()
+    test_subjects = subjects_array[test_idx].tolist()
     # Corresponding subject IDs for train/test
-    train_subject_ids = [extract_subject_id(s) for s in train_subjects] if no_subdirs else train_subjects
-    test_subject_ids = [extract_subject_id(s) for s in test_subjects] if no_subdirs else test_subjects
+    train_subject_ids = ids_array[train_idx].tolist()
+    test_subject_ids = ids_array[test_idx].tolist()
 
     # Move/copy subjects or files to their respective directories
-    if not skip_copy:
-        for subject in train_subjects:
-            src = os.path.join(base_dir, subject)
-            dst = os.path.join(train_dir, subject)
-            if no_subdirs:
-                shutil.copy(src, dst)
-            else:
-                shutil.copytree(src, dst)
-
-        for subject in test_subjects:
-            src = os.path.join(base_dir, subject)
-            dst = os.path.join(test_dir, subject)
-            if no_subdirs:
-                shutil.copy(src, dst)
-            else:
-                shutil.copytree(src, dst)
+    if not skip_copy and shard_size_mb:
+        write_shards(base_dir, train_subjects, train_subject_ids, train_dir, shard_size_mb)
+        write_shards(base_dir, test_subjects, test_subject_ids, test_dir, shard_size_mb)
+
+        print(f"Training set: {len(train_subjects)} subjects")
+        print(f"Test set: {len(test_subjects)} subjects")
+
+    elif not skip_copy:
+        copies = [(subject, train_dir) for subject in train_subjects] + [(subject, test_dir) for subject in test_subjects]
+
+        # Copies are I/O-bound and independent, so run them in parallel threads
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(copy_subject, os.path.join(base_dir, subject), os.path.join(out_dir, subject), no_subdirs, link, resume)
+                for subject, out_dir in copies
+            ]
+            for future in futures:
+                future.result()
 
         print(f"Training set: {len(train_subjects)} subjects")
         print(f"Test set: {len(test_subjects)} subjects")
 
+    elif dry_run:
+        print(f"Dry run: {len(train_subjects)} train and {len(test_subjects)} test subjects, nothing written.")
+
     else:
         print(f"Skipping file/directory moving or copying. Train/Test splits computed only.")
 
@@ -130,12 +342,12 @@ def split_dataset(base_dir, train_dir, test_dir, test_size=0.15, no_subdirs=Fals
         }
 
         # Save individual dataset-specific JSONs
-        with open(train_json_named, 'w') as train_file:
-            json.dump(train_data, train_file)
-        with open(test_json_named, 'w') as test_file:
-            json.dump(test_data, test_file)
+        save_json_file(train_data, train_json_named)
+        save_json_file(test_data, test_json_named)
         print(f"Dataset-specific Train subjects saved to: {train_json_named}")
         print(f"Dataset-specific Test subjects saved to: {test_json_named}")
 
+    return {'train': train_subject_ids, 'test': test_subject_ids}
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
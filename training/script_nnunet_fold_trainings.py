@@ -1,5 +1,9 @@
+import os
+import queue
+import shlex
 import subprocess
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import torch
 
 def main():
@@ -10,42 +14,91 @@ def main():
     parser.add_argument('--plans', nargs='+', required=True, help='List of plans')
     parser.add_argument('--debug', action='store_true', help='Enable debug mode to print commands without executing them')
     parser.add_argument('--start_fra_fold', type=int, help="If flag set, restart the training from fold #N which is provided by the user with this flag.")
+    parser.add_argument('--gpus', nargs='+', help="GPU IDs to train on in parallel, one training per GPU at a time (e.g., --gpus 0 1 2 3). If not set, trainings run one after the other on the default device.")
+    parser.add_argument('--isolate', action='store_true', help="Run each training in its own nnUNetv2_train process (always the case with --gpus). By default, trainings run one after the other inside this process, so torch and CUDA are only initialized once.")
 
     args = parser.parse_args()
 
     start_fold = args.start_fra_fold if args.start_fra_fold is not None else 0
 
-    for dataset in args.datasets:
-        for configuration in args.configurations:
-            for plan in args.plans:
-                for trainer in args.trainer:
-                    for fold in range(start_fold, 5):
-                        run_training(dataset, configuration, trainer, fold, plan, args.debug)
+    # Every (dataset, configuration, plan, trainer, fold) training is independent
+    jobs = [
+        (dataset, configuration, trainer, fold, plan)
+        for dataset in args.datasets
+        for configuration in args.configurations
+        for plan in args.plans
+        for trainer in args.trainer
+        for fold in range(start_fold, 5)
+    ]
+
+    if args.gpus:
+        # Each worker takes a free GPU for the duration of one training, then gives it back
+        free_gpus = queue.Queue()
+        for gpu_id in args.gpus:
+            free_gpus.put(gpu_id)
+
+        def run_on_free_gpu(job):
+            gpu_id = free_gpus.get()
+            try:
+                run_training(*job, debug=args.debug, gpu_id=gpu_id, isolate=True)
+            finally:
+                free_gpus.put(gpu_id)
+
+        with ThreadPoolExecutor(max_workers=len(args.gpus)) as executor:
+            for future in [executor.submit(run_on_free_gpu, job) for job in jobs]:
+                future.result()
+    else:
+        if not args.isolate and not args.debug:
+            # Fail once here, not once per fold, if nnU-Net cannot be imported
+            import nnunetv2.run.run_training  # noqa: F401
+            # Thread setup done by nnUNetv2_train for CUDA runs (torch threads do not help on GPU);
+            # the interop pool can only be sized once per process, so it is done before the sweep
+            torch.set_num_threads(1)
+            torch.set_num_interop_threads(1)
+        for job in jobs:
+            run_training(*job, debug=args.debug, isolate=args.isolate)
 
     print("All trainings have been completed.")
 
-def run_training(dataset, configuration, trainer, fold, plan, debug=False):
+BANNER_BAR = '|' * 84
+
+def run_training(dataset, configuration, trainer, fold, plan, debug=False, gpu_id=None, isolate=True):
         
     command = ["nnUNetv2_train", dataset, configuration, str(fold), "--npz", "-p", plan, "-tr", trainer, "--val_best"]
-    print('|')
-    print(f"Executing command: {' '.join(command)}")
-    print('|')
+    env = None
+    if gpu_id is not None:
+        # Restrict the training to its assigned GPU
+        env = {**os.environ, 'CUDA_VISIBLE_DEVICES': str(gpu_id)}
+    run_name = f"dataset {dataset}, configuration {configuration}, fold {fold}, plan {plan}"
+    # Each banner is printed in one call, so banners of parallel trainings do not interleave
+    print(f"|\nExecuting command: {shlex.join(command)}" + (f" on GPU {gpu_id}" if gpu_id is not None else "") + "\n|", flush=True)
 
     if debug:
         print(f"Debug mode: {command}")
     else:
         try:
-            print('||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||')
-            print(f"Starting training for dataset {dataset}, configuration {configuration}, fold {fold}, plan {plan}")
-            result = subprocess.run(command, check=True, capture_output=True, text=True)
-            print(f"Finished training for dataset {dataset}, configuration {configuration}, fold {fold}, plan {plan}")
-            print('||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||')
-            print(result.stdout)
+            print(f"{BANNER_BAR}\nStarting training for {run_name}", flush=True)
+            if isolate:
+                # Stream the training log line by line instead of holding all of it in memory until the end
+                prefix = f"[GPU {gpu_id}] " if gpu_id is not None else ""
+                with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, env=env) as proc:
+                    for line in proc.stdout:
+                        print(prefix + line, end='', flush=True)
+                if proc.returncode:
+                    raise subprocess.CalledProcessError(proc.returncode, command)
+            else:
+                # Equivalent of the nnUNetv2_train command above on CUDA (thread setup done once in main),
+                # without a new interpreter (and torch/CUDA start-up) per fold
+                from nnunetv2.run.run_training import run_training as nnunet_run_training
+                nnunet_run_training(dataset, configuration, fold, trainer_class_name=trainer, plans_identifier=plan,
+                                    export_validation_probabilities=True, val_with_best=True, device=torch.device('cuda'))
+            print(f"Finished training for {run_name}\n{BANNER_BAR}", flush=True)
             torch.cuda.empty_cache()
-        except subprocess.CalledProcessError as e:
-            print('||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||')
-            print(f"~~~~~~!!!!!!!!!!!Training for dataset {dataset}, configuration {configuration}, fold {fold}, plan {plan} FAILED with error: {e.stderr}!!!!!!!!!!!!~~~~~~~")
-            print('||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||||')
+        except ImportError:
+            # A broken nnU-Net install fails every fold the same way: stop the sweep
+            raise
+        except Exception as e:
+            print(f"{BANNER_BAR}\n~~~~~~!!!!!!!!!!!Training for {run_name} FAILED with error: {e} (see the log above)!!!!!!!!!!!!~~~~~~~\n{BANNER_BAR}", flush=True)
             torch.cuda.empty_cache()
 
 if __name__ == "__main__":